@@ -0,0 +1,225 @@
+"""
+Canonical, interned linear atoms.
+
+Z3's simplify() does not give a canonical form for LIA atoms, e.g. 2*x <= 6 and x <= 3, or Not(8 <= x) and x <= 7
+stay different. Here every atom is normalized to one of
+  a.x <= b,  a.x == b,  a.x != b
+with variables sorted by name, coefficients divided by their gcd(b is rounded down for <=), strict bounds tightened
+using integrality and the first coefficient of (dis)equalities made positive. Each normal form gets a small integer id,
+and clauses and cubes are keyed by the sorted tuple of the ids of their literals.
+
+Atoms that are not linear integer constraints(booleans, reals, ...) are interned by their sexpr, so they still get
+an id but are only equal to syntactically identical atoms.
+
+To run automated tests using doctest, do: python3 -m doctest atoms.py [-v]
+"""
+
+from z3 import *
+
+from math import gcd
+from functools import reduce
+
+def linear_form(term):
+  """
+  Returns (coeffs, const) s.t. term == sum(coeffs[v]*v) + const, coeffs maps variable names to non-zero ints.
+  Raises ValueError if term is not a linear integer term.
+
+  >>> x,y = Ints('x y')
+  >>> linear_form(2*x - (y - 3)*4 + y)
+  ({'x': 2, 'y': -3}, 12)
+  """
+  if is_int_value(term):
+    return {}, term.as_long()
+  elif is_const(term) and is_int(term):
+    return {term.decl().name(): 1}, 0
+  elif is_add(term) or is_sub(term):
+    parts = [linear_form(child) for child in term.children()]
+    signs = [1] + [1 if is_add(term) else -1]*(len(parts)-1)
+    coeffs, const = {}, 0
+    for sign, (c, k) in zip(signs, parts):
+      for var in c:
+        coeffs[var] = coeffs.get(var, 0) + sign*c[var]
+      const += sign*k
+    return dict([(var, a) for var, a in coeffs.items() if a != 0]), const
+  elif is_app_of(term, Z3_OP_UMINUS):
+    c, k = linear_form(term.children()[0])
+    return dict([(var, -a) for var, a in c.items()]), -k
+  elif is_mul(term):
+    parts = [linear_form(child) for child in term.children()]
+    varying = [(c, k) for c, k in parts if c]
+    if len(varying) > 1:
+      raise ValueError("Non-linear term %s" % term)
+    factor = reduce(lambda a, b: a*b, [k for c, k in parts if not c], 1)
+    c, k = varying[0] if varying else ({}, 1)
+    return dict([(var, a*factor) for var, a in c.items() if a*factor != 0]), k*factor
+  else:
+    raise ValueError("Non-linear term %s" % term)
+
+def normalize(atom):
+  """
+  Returns the normal form of atom(a comparison, possibly under Not) as (op, ((var, coeff), ...), bound),
+  or ('true',) / ('false',) for constant atoms. Raises ValueError for non-LIA atoms.
+
+  >>> x,y = Ints('x y')
+  >>> normalize(2*x <= 6) == normalize(x <= 3) == normalize(Not(8 <= x + 4))
+  True
+  >>> normalize(Not(8 <= x))
+  ('<=', (('x', 1),), 7)
+  >>> normalize(2*y - 4 == -2*x)
+  ('==', (('x', 1), ('y', 1)), 2)
+  >>> normalize(2*x == 3)
+  ('false',)
+  """
+  negated = False
+  while is_not(atom):
+    negated = not negated
+    atom = atom.children()[0]
+  if is_true(atom) or is_false(atom):
+    return ('true',) if is_true(atom) != negated else ('false',)
+  if len(atom.children()) != 2 or not is_int(atom.children()[0]):
+    raise ValueError("Not a linear integer atom %s" % atom)
+
+  lhs, rhs = [linear_form(child) for child in atom.children()]
+  coeffs = dict(lhs[0])
+  for var, a in rhs[0].items():
+    coeffs[var] = coeffs.get(var, 0) - a
+  coeffs = dict([(var, a) for var, a in coeffs.items() if a != 0])
+  const = lhs[1] - rhs[1]  # atom is: coeffs.x + const OP 0
+
+  neg = lambda c: dict([(var, -a) for var, a in c.items()])
+  if is_le(atom):
+    op, bound = '<=', -const
+  elif is_lt(atom):
+    op, bound = '<=', -const - 1
+  elif is_ge(atom):
+    op, coeffs, bound = '<=', neg(coeffs), const
+  elif is_gt(atom):
+    op, coeffs, bound = '<=', neg(coeffs), const - 1
+  elif is_eq(atom):
+    op, bound = '==', -const
+  elif is_distinct(atom):
+    op, bound = '!=', -const
+  else:
+    raise ValueError("Not a linear integer atom %s" % atom)
+
+  if negated:
+    if op == '<=': # Not(a.x <= b) <=> -a.x <= -b-1
+      coeffs, bound = neg(coeffs), -bound - 1
+    else:
+      op = '!=' if op == '==' else '=='
+
+  if not coeffs:
+    holds = {'<=': 0 <= bound, '==': bound == 0, '!=': bound != 0}[op]
+    return ('true',) if holds else ('false',)
+
+  g = reduce(gcd, [abs(a) for a in coeffs.values()])
+  if op == '<=':
+    bound = bound // g
+  elif bound % g != 0:
+    return ('false',) if op == '==' else ('true',)
+  else:
+    bound = bound // g
+  terms = sorted([(var, a // g) for var, a in coeffs.items()])
+  if op != '<=' and terms[0][1] < 0:
+    terms, bound = [(var, -a) for var, a in terms], -bound
+  return (op, tuple(terms), bound)
+
+def canonical(fml):
+  """
+  Returns a string that is the same for formulas differing only in the order(or repetition) of And/Or arguments
+  and in the way linear atoms are written. Used to hash problems.
+
+  >>> x,y = Ints('x y')
+  >>> canonical(And(x <= 3, Or(y > 0, 2*x >= 1))) == canonical(And(Or(x >= 1, Not(y <= 0)), 2*x <= 7))
+  True
+  >>> canonical(Or(x >= 1, y == 0))
+  "(or ('<=', (('x', -1),), -1) ('==', (('y', 1),), 0))"
+  """
+  if is_and(fml) or is_or(fml):
+    children = sorted(set([canonical(child) for child in fml.children()]))
+    return "(%s %s)" % ("and" if is_and(fml) else "or", " ".join(children))
+  try:
+    return repr(normalize(fml))
+  except ValueError:
+    pass
+  if is_app(fml) and fml.num_args() > 0:
+    return "(%s %s)" % (fml.decl().name(), " ".join([canonical(child) for child in fml.children()]))
+  return fml.sexpr()
+
+class AtomTable(object):
+  """
+  Interns normalized atoms. Each distinct normal form gets the next free integer id.
+
+  >>> x = Int('x')
+  >>> t = AtomTable()
+  >>> t.intern(x <= 3), t.intern(2*x <= 7), t.intern(Not(x >= 4)), t.intern(x >= 4)
+  (0, 0, 0, 1)
+  >>> t.clause_key(Or(x >= 4, 2*x <= 6, x < 4))
+  (0, 1)
+
+  intern() memoizes by ast id and keeps the memoized atoms alive(so that their ids are not reused), so the memo is
+  emptied whenever it holds more than max_memo atoms. The normal forms and their ids are kept until clear().
+  """
+  def __init__(self, max_memo=100000):
+    self.ids = {}
+    self.atoms = []
+    self.max_memo = max_memo
+    self._memo = {} #ast id -> (atom, id). Keeps atom alive so that its ast id is not reused.
+
+  def __len__(self):
+    return len(self.atoms)
+
+  def clear(self):
+    """
+    Forgets all atoms, e.g. between unrelated problems in a long running process.
+    Keys computed before are meaningless afterwards, so no ConjFml built before may be used again.
+
+    >>> x = Int('x')
+    >>> t = AtomTable()
+    >>> t.intern(x <= 3), t.intern(x >= 4)
+    (0, 1)
+    >>> t.clear()
+    >>> len(t), t.intern(x >= 4)
+    (0, 0)
+    """
+    self.ids = {}
+    self.atoms = []
+    self._memo = {}
+
+  def intern(self, atom):
+    """
+    Returns id of atom(BoolRef).
+    """
+    hit = self._memo.get(atom.get_id())
+    if hit is not None:
+      return hit[1]
+    try:
+      key = normalize(atom)
+    except ValueError:
+      key = ('raw', atom.sexpr())
+    if key not in self.ids:
+      self.ids[key] = len(self.atoms)
+      self.atoms.append(key)
+    if len(self._memo) >= self.max_memo:
+      self._memo = {}
+    self._memo[atom.get_id()] = (atom, self.ids[key])
+    return self.ids[key]
+
+  def clause_key(self, clause):
+    """
+    Returns sorted tuple of ids of the literals of clause(Or of literals or a single literal).
+    """
+    lits = clause.children() if is_or(clause) else [clause]
+    return tuple(sorted(set([self.intern(lit) for lit in lits])))
+
+  def cube_key(self, cube):
+    """
+    Returns sorted tuple of ids of the literals of cube(And of literals, a single literal or an iterable of literals).
+    """
+    lits = cube.children() if is_expr(cube) and is_and(cube) else [cube] if is_expr(cube) else list(cube)
+    return tuple(sorted(set([self.intern(lit) for lit in lits])))
+
+table = AtomTable()
+"""
+Process wide table, used by ConjFml.
+"""
@@ -0,0 +1,126 @@
+"""
+On-disk cache of results and lemmas, so that re-verifying an unchanged problem is free and an edited one starts warm.
+
+Two kinds of entries are kept under the cache directory, both as gzipped JSON with formulas as SMT-LIB text:
+  results/<fingerprint>  verdict, message and inductive invariant of a problem, keyed by checkpoint.fingerprint(I,T,P).
+  lemmas/<signature>     lemmas learnt on any problem over the same state variables.
+Several processes may share a cache directory: files are replaced atomically and merges into a lemma pool are
+serialized by a lock file next to it.
+Lemmas depend only on I and T, which may have been edited since they were learnt, so they are never trusted as is:
+seeds() filters them down to an inductive subset of the current I and T(see formula.inductive_subset), which costs
+one inductiveness check per lemma per round.
+
+To run automated tests using doctest, do: python3 -m doctest cache.py [-v]
+"""
+
+from pdr import *
+from checkpoint import fingerprint, declarations, parse_clauses, write_json, read_json
+
+import pdr as engine #For engine.do_debug, which may be changed after import.
+
+import fcntl
+import hashlib
+import os
+
+default_dir = os.path.join(os.path.expanduser("~"), ".cache", "pdr-lia")
+
+class Cache(object):
+  """
+  Result and lemma cache rooted at path. I, T and P given to the methods must be BoolRef.
+  max_lemmas bounds the size of each lemma pool, the oldest lemmas are dropped first.
+
+  >>> import tempfile, pdr as engine
+  >>> engine.do_debug = False
+  >>> cache = Cache(tempfile.mkdtemp())
+  >>> x,y,_p_x,_p_y = Ints('x y _p_x _p_y')
+  >>> I, P = And(x==0,y==8), to_ConjFml(Not(And(x==0,y==0)))
+  >>> T = Or(And(x < 8, y <= 8, _p_x == x + 2, _p_y == y - 2),And(x == 8, _p_x == 0, y == 0, _p_y == 8))
+  >>> cached_pdr(I, T, P, cache).valid
+  True
+  >>> cache.lookup(I, T, P.as_expr()).msg.endswith("(cached)")
+  True
+  >>> T2 = Or(And(x < 8, y <= 8, _p_x == x + 2, _p_y == y - 2),And(x == 8, _p_x == 0, y == 0, _p_y == 6))
+  >>> cache.lookup(I, T2, P.as_expr()) is None
+  True
+  >>> len(cache.seeds(I, T2, P.as_expr())) > 0
+  True
+  """
+  def __init__(self, path=default_dir, max_lemmas=1000):
+    self.path = path
+    self.max_lemmas = max_lemmas
+    for sub in ["results", "lemmas"]:
+      os.makedirs(os.path.join(path, sub), exist_ok=True)
+
+  def _result_path(self, I, T, P):
+    return os.path.join(self.path, "results", fingerprint(I, T, P) + ".json.gz")
+
+  def _lemma_path(self, I, T, P):
+    names = sorted(set([str(var) for var in state_vars(I, T, P)]))
+    return os.path.join(self.path, "lemmas", hashlib.sha1(" ".join(names).encode()).hexdigest() + ".json.gz")
+
+  def lookup(self, I, T, P):
+    """
+    Returns the cached Result for the problem, None on a miss.
+    """
+    path = self._result_path(I, T, P)
+    if not os.path.exists(path):
+      return None
+    data = read_json(path)
+    invariant = parse_clauses(data["declarations"], data["invariant"]) if data["invariant"] is not None else None
+    return Result(data["valid"], data["msg"] + "\n  (cached)", invariant=invariant)
+
+  def seeds(self, I, T, P):
+    """
+    Returns the lemmas of the pool for the state variables of the problem that form an inductive invariant of I, T.
+    """
+    path = self._lemma_path(I, T, P)
+    if not os.path.exists(path):
+      return []
+    data = read_json(path)
+    try:
+      lemmas = list(parse_clauses(data["declarations"], data["lemmas"]))
+    except Z3Exception: #Pool written with other declarations, e.g. a var changed sort.
+      return []
+    return inductive_subset(I, T, lemmas)
+
+  def store(self, I, T, P, res):
+    """
+    Stores res(a Result) for the problem, and adds its invariant and frame lemmas to the pool for its state variables.
+    Inconclusive results only contribute lemmas.
+    """
+    decls = declarations(I, T, P)
+    invariant = list(res.invariant) if res.invariant is not None else None
+    if res.valid is not None:
+      write_json(self._result_path(I, T, P), {
+        "version": 1,
+        "declarations": decls,
+        "valid": res.valid,
+        "msg": res.msg,
+        "invariant": [clause.sexpr() for clause in invariant] if invariant is not None else None,
+      })
+
+    lemmas = [lem.sexpr() for lem in (invariant or []) + res.lemmas()]
+    if not lemmas:
+      return
+    path = self._lemma_path(I, T, P)
+    with open(path + ".lock", "w") as lock: #Other processes may merge into the same pool.
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      pool = read_json(path)["lemmas"] if os.path.exists(path) else []
+      pool = list(dict.fromkeys(pool + lemmas))[-self.max_lemmas:]
+      write_json(path, {"version": 1, "declarations": decls, "lemmas": pool})
+
+def cached_pdr(I, T, P, cache=None, **kwargs):
+  """
+  pdr() answered from cache(a Cache, the default one if None) when possible. Takes the same I, T, P as pdr().
+  On a miss, pdr() is seeded with the validated lemmas of earlier runs and its result is stored.
+  """
+  cache = cache if cache is not None else Cache()
+  res = cache.lookup(I, T, P.as_expr())
+  if res is not None:
+    return res
+
+  seed = cache.seeds(I, T, P.as_expr())
+  print("Seeding frame 1 with %i cached lemmas: %s" % (len(seed), seed)) if engine.do_debug else print(end='')
+  res = pdr(I, T, P, seed=seed, **kwargs)
+  cache.store(I, T, P.as_expr(), res)
+  return res
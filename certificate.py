@@ -0,0 +1,127 @@
+"""
+Inductive invariant certificates. A SAFE answer is backed by an invariant Inv with
+  initiation:  I => Inv                  i.e. UNSAT(I && !Inv)
+  consecution: Inv && T => Inv'          i.e. UNSAT(Inv && T && !Inv')
+  safety:      Inv => P                  i.e. UNSAT(Inv && !P)
+A certificate is a self-contained SMT-LIB script that defines init, trans, prop and inv and runs these three queries,
+so any SMT solver re-validates it: the answer is correct iff the output is unsat three times.
+Re-checking costs three solver calls instead of a PDR run, e.g. in CI or after upgrading Z3.
+
+A certificate only speaks about the init, trans and prop written into it. To find out whether it still holds after
+the problem was edited, check it against the current problem: its inv is then checked with the current I, T and P,
+so it passes iff it is still an inductive invariant proving P.
+
+To check certificates from the command line, do: python3 certificate.py cert.smt2 [cert2.smt2 ...] [--problem PROBLEM]
+where PROBLEM is a JSON file with the current problem in the request format of server.py(declarations, init, trans
+and prop as SMT-LIB text).
+To run automated tests using doctest, do: python3 -m doctest certificate.py [-v]
+"""
+
+from formula import *
+from checkpoint import declarations, parse_clauses
+
+from sys import exit
+import argparse
+import json
+
+conditions = ["initiation", "consecution", "safety"]
+
+def certificate(I, T, P, inv):
+  """
+  Returns the certificate for invariant inv(ConjFml or BoolRef) of the problem(I, T, P as BoolRef) as SMT-LIB text.
+  """
+  inv = inv.as_expr() if isinstance(inv, Goal) else inv
+  svars = state_vars(I, T, P, inv)
+  inv_p = substitute(inv, list(zip(svars, Ints(["_p_%s" % var for var in svars]))))
+
+  lines = ["; Inductive invariant certificate. Expected output: unsat, unsat, unsat.",
+           declarations(I, T, P, inv, inv_p),
+           "(define-fun init () Bool %s)" % I.sexpr(),
+           "(define-fun trans () Bool %s)" % T.sexpr(),
+           "(define-fun prop () Bool %s)" % P.sexpr(),
+           "(define-fun inv () Bool %s)" % inv.sexpr(),
+           "(define-fun inv_p () Bool %s)" % inv_p.sexpr(),
+           "; initiation",
+           "(push 1)(assert (and init (not inv)))(check-sat)(pop 1)",
+           "; consecution",
+           "(push 1)(assert (and inv trans (not inv_p)))(check-sat)(pop 1)",
+           "; safety",
+           "(push 1)(assert (and inv (not prop)))(check-sat)(pop 1)"]
+  return "\n".join(lines) + "\n"
+
+def write_certificate(path, I, T, P, inv):
+  """
+  Writes certificate(I, T, P, inv) to path.
+  """
+  with open(path, "w") as f:
+    f.write(certificate(I, T, P, inv))
+
+def invariant(text):
+  """
+  Returns the invariant of a certificate(SMT-LIB text) as a BoolRef.
+
+  >>> x,_p_x = Ints('x _p_x')
+  >>> invariant(certificate(x == 0, _p_x == x + 1, x != -1, And(x >= 0, x != 7)))
+  And(x >= 0, x != 7)
+  """
+  head = text.split("\n; initiation\n")[0] #Declarations and definitions, without the queries.
+  return parse_smt2_string(head + "(assert inv)")[0]
+
+def check(text, I=None, T=None, P=None):
+  """
+  Runs a certificate(SMT-LIB text) and returns the list of conditions that do not hold, empty if it is valid.
+  If the current problem(I, T, P as BoolRef) is given, the invariant of the certificate is checked against it instead.
+
+  >>> x,_p_x = Ints('x _p_x')
+  >>> check(certificate(x == 0, _p_x == x + 1, x != -1, x >= 0))
+  []
+  >>> check(certificate(x == 0, _p_x == x + 1, x != -1, x <= 5))
+  ['consecution', 'safety']
+  >>> cert = certificate(x == 0, _p_x == x + 1, x != -1, x >= 0)
+  >>> check(cert, x == 0, _p_x == x + 2, x != -2), check(cert, x == 0, _p_x == x - 1, x != -1)
+  ([], ['consecution'])
+  >>> check("(assert", x == 0, _p_x == x + 1, x != -1)
+  ['initiation', 'consecution', 'safety']
+  """
+  if I is not None:
+    try:
+      text = certificate(I, T, P, invariant(text))
+    except Z3Exception: #Malformed certificate.
+      return list(conditions)
+  ctx = Context() #Fresh context, the declarations of another certificate must not clash.
+  try:
+    out = Z3_eval_smtlib2_string(ctx.ref(), text).split()
+  except Z3Exception: #Malformed certificate.
+    return list(conditions)
+  if len(out) != len(conditions):
+    return list(conditions)
+  return [cond for cond, ans in zip(conditions, out) if ans != "unsat"]
+
+def check_certificate(path, I=None, T=None, P=None):
+  """
+  Same as check() for the certificate stored at path.
+  """
+  with open(path) as f:
+    return check(f.read(), I, T, P)
+
+def load_problem(path):
+  """
+  Reads a problem from a JSON file in the request format of server.py and returns (I, T, P) as BoolRef.
+  """
+  with open(path) as f:
+    job = json.load(f)
+  return tuple([parse_clauses(job.get("declarations", ""), [job[key]]).as_expr() for key in ["init", "trans", "prop"]])
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Checks inductive invariant certificates.")
+  parser.add_argument("certificates", nargs="+", help="Certificate files(SMT-LIB).")
+  parser.add_argument("--problem", help="JSON file with the current problem, to check the certificates against it.")
+  args = parser.parse_args()
+  problem = load_problem(args.problem) if args.problem is not None else ()
+
+  failed = False
+  for path in args.certificates:
+    bad = check_certificate(path, *problem)
+    print("%s: %s" % (path, "OK" if not bad else "FAILED " + ", ".join(bad)))
+    failed = failed or bool(bad)
+  exit(1 if failed else 0)
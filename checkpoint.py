@@ -0,0 +1,124 @@
+"""
+Checkpointing of the PDR trace, so that a long run killed midway(OOM, preemption) can be resumed instead of restarted.
+
+A checkpoint holds the frames(lemmas as SMT-LIB text), the proof obligation queue(with the disjunct of each obligation,
+see pdr(partition=True)), the frontier index n and the run statistics, as gzipped JSON. It is written to a temporary file first and then renamed over the previous one, so a run
+killed while saving still leaves the previous checkpoint intact.
+
+To run automated tests using doctest, do: python3 -m doctest checkpoint.py [-v]
+"""
+
+from formula import *
+from atoms import canonical
+
+from heapq import heapify
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+def fingerprint(I, T, P):
+  """
+  Returns a hash of the canonical form(see atoms.canonical) of the problem. I, T and P must be BoolRef.
+  Used to refuse resuming a checkpoint written for another problem, and as the key of cache.py.
+
+  >>> x,_p_x = Ints('x _p_x')
+  >>> fingerprint(x == 0, Or(_p_x == x + 1, _p_x == 0), x < 5) == fingerprint(0 == x, Or(_p_x == 0, _p_x - x == 1), x <= 4)
+  True
+  """
+  return hashlib.sha1(("%s\n%s\n%s" % (canonical(I), canonical(T), canonical(P))).encode()).hexdigest()
+
+def write_json(path, data):
+  """
+  Writes data to path as gzipped JSON. Goes through a temporary file of its own, so path is never left half written
+  and concurrent writers(e.g. server.py workers sharing a cache) do not clobber each other's temporary file.
+  """
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+  try:
+    with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt") as f:
+      json.dump(data, f)
+    os.replace(tmp, path)
+  except BaseException:
+    os.remove(tmp)
+    raise
+
+def read_json(path):
+  """
+  Reads gzipped JSON written by write_json().
+  """
+  with gzip.open(path, "rt") as f:
+    return json.load(f)
+
+def declarations(*fmls):
+  """
+  Returns SMT-LIB declarations of all variables in fmls.
+
+  >>> x,_p_x = Ints('x _p_x')
+  >>> declarations(And(x >= 0, _p_x == x + 1))
+  '(declare-fun x () Int)(declare-fun _p_x () Int)'
+  """
+  acc = []
+  for fml in fmls:
+    acc.extend(get_vars(fml))
+  return "".join(["(declare-fun %s () %s)" % (var.sexpr(), var.sort().sexpr()) for var in dict.fromkeys(acc)])
+
+def parse_clauses(decls, clauses):
+  """
+  Parses clauses(list of SMT-LIB terms) given the declarations and returns them as a ConjFml.
+  """
+  conj = ConjFml()
+  conj.add(list(parse_smt2_string(decls + "".join(["(assert %s)" % clause for clause in clauses]))))
+  return conj
+
+def save(path, I, T, P, frames, pQueue, n, stats):
+  """
+  Writes the trace state to path. I, T and P must be BoolRef.
+
+  >>> import tempfile
+  >>> x,_p_x = Ints('x _p_x')
+  >>> I, T, P = x == 0, _p_x == x + 2, x != 5
+  >>> frames = [to_ConjFml(I), to_ConjFml(P)]
+  >>> path = os.path.join(tempfile.mkdtemp(), 'trace.ckpt')
+  >>> cube = to_ConjFml(x == 3)
+  >>> cube.disjunct = 0
+  >>> save(path, I, T, P, frames, [(1, cube)], 1, {'lemmas': 0})
+  >>> frames, pQueue, n, stats = load(path, I, T, P)
+  >>> frames, pQueue, n, stats
+  ([[x == 0], [Not(x == 5)]], [(1, [x == 3])], 1, {'lemmas': 0})
+  >>> pQueue[0][1].disjunct
+  0
+  >>> load(path, I, T, x != 7) # doctest: +ELLIPSIS
+  Traceback (most recent call last):
+  ...
+  ValueError: Checkpoint ... was written for a different problem.
+  """
+  data = {
+    "version": 1,
+    "fingerprint": fingerprint(I, T, P),
+    "declarations": declarations(I, T, P),
+    "n": n,
+    "stats": stats,
+    "frames": [[clause.sexpr() for clause in frame] for frame in frames],
+    "queue": [[level, [atom.sexpr() for atom in cube], getattr(cube, "disjunct", None)] for level, cube in pQueue],
+  }
+  write_json(path, data)
+
+def load(path, I, T, P):
+  """
+  Reads a checkpoint written by save() for the same I, T, P(BoolRef).
+  Returns (frames, pQueue, n, stats). Frames are new ConjFml, so their solvers are rebuilt from the saved lemmas.
+  """
+  data = read_json(path)
+  if data["fingerprint"] != fingerprint(I, T, P):
+    raise ValueError("Checkpoint %s was written for a different problem." % path)
+
+  decls = data["declarations"]
+  frames = [parse_clauses(decls, clauses) for clauses in data["frames"]]
+  pQueue = []
+  for entry in data["queue"]: #[level, atoms, disjunct], disjunct is missing in older checkpoints.
+    cube = parse_clauses(decls, entry[1])
+    cube.disjunct = entry[2] if len(entry) > 2 else None
+    pQueue.append((entry[0], cube))
+  heapify(pQueue)
+  return frames, pQueue, data["n"], data["stats"]
@@ -8,10 +8,10 @@ To run automated tests using doctest, do: python3 -m doctest formula.py [-v]
 
 from z3 import *  #..bad!
 from z3.z3util import get_vars
+from atoms import table as atom_table
 
-from collections import Iterable
+from collections.abc import Iterable
 from functools import reduce
-from sys import exit
 import itertools
 # from bidict import bidict
 
@@ -41,12 +41,32 @@ class ConjFml(Goal):
   safe_varlist denotes that list of primes and unprimed variables is up to date. 
   If it is set to False, you need to run update_vars.
 
+  self.keys is the set of clause keys(sorted tuples of interned atom ids, see atoms.py) of the clauses added so far.
+  Equivalent atoms such as 2*x <= 6 and x <= 3 get the same id, so has() and == do not depend on how z3 prints them.
+
+  The solver only ever grows: besides the live clauses it keeps learnt clauses and other internal state of every
+  check, and any assertion left behind by an unbalanced push/pop. recycle() is called at points where no scope is
+  open(after the push/pop in propagate and generalization, and after every recycle_every-th add(), since counting
+  the assertions costs as much as the frame is long) and rebuilds the solver from the live clauses when one of the
+  class wide thresholds below is crossed. Set a threshold to None to disable it.
+    max_assertion_ratio: solver holds more than this many assertions per live clause.
+    max_conflicts: solver has run into this many conflicts since it was built, a proxy for its learnt state.
+    max_memory: Z3's memory use in MB is above this. Z3 only reports it for the whole process, so this is a global 
+                ceiling rather than per frame accounting: once it is crossed, each frame solver that ran at least
+                recycle_every checks since it was built is rebuilt at its next recycle().
+  self.recycled counts the rebuilds of this frame.
+
   #FUTURE TODO: Store clauses in a set, this would allow deletion, musch faster __contains__, 
     but not sure if it'd be true speed up as z3 GoalObj isn't mutable.
   #This would need ConjFml to be it's own class, i.e. not extending Goal.
 
   For large global TS, keep two solvers per frame? One with TS the other without. ???
   """
+  max_assertion_ratio = 2
+  max_conflicts = 100000
+  max_memory = None
+  recycle_every = 64
+
   def __init__(self):
 
     # if not isinstance(id, str):
@@ -58,12 +78,16 @@ class ConjFml(Goal):
     self.unprimed = []
     self.primed = []
     self.safe_varlist = True 
+    self.keys = set()
+    self.recycled = 0
+    self.adds = 0
     self.solver = Solver()
     self.solver.push()
 
   def __eq__(self, other):
     """
-    Equal iff of same type and have the same clauses.
+    Equal iff of same type and have the same clauses. Two ConjFml are compared by clause keys, 
+    so equivalent atoms and duplicate clauses do not matter.
   
     >>> x,y = Ints('x y')
     >>> g = ConjFml()
@@ -74,10 +98,16 @@ class ConjFml(Goal):
     True
     >>> g == f
     True
+    >>> f.add([Or(2*y <= 2, Not(x <= -1))])
+    >>> g == f
+    True
     """
     if not isinstance(other, type(self)) and not isinstance(other, type(Goal())):
       raise TypeError("'%s' is not of type '%s' or %s." % (other,type(self),type(Goal())))
 
+    if isinstance(other, type(self)):
+      return self.keys == other.keys
+
     if len(self) != len(other):
       return False
     else:
@@ -211,12 +241,76 @@ class ConjFml(Goal):
     fmls = simplifyAll(fmls)
     super(ConjFml, self).add(fmls)
     self.safe_varlist = False
+    self.keys.update(map(atom_table.clause_key, fmls))
 
     self.solver.add(fmls) # No need to push since clauses never get removed from frames. push() manually if needed.
+    self.adds += 1
+    if self.adds % ConjFml.recycle_every == 0:
+      self.recycle()
 
     if update:
       self.update_vars()
 
+  def solver_stats(self):
+    """
+    Returns the figures recycle() decides on: number of assertions and open scopes of the solver, its checks and
+    conflicts so far and Z3's current memory use in MB.
+
+    >>> x = Int('x')
+    >>> g = ConjFml()
+    >>> g.add([x >= 2, x <= 4])
+    >>> stats = g.solver_stats()
+    >>> stats['assertions'], stats['scopes'], stats['checks'], stats['conflicts']
+    (2, 1, 0, 0)
+    """
+    st = self.solver.statistics()
+    get = lambda key: st.get_key_value(key) if key in st.keys() else 0
+    return {'assertions': len(self.solver.assertions()), 'scopes': self.solver.num_scopes(),
+            'checks': get('num checks'), 'conflicts': get('conflicts'),
+            'memory': Z3_get_estimated_alloc_size() / 2.0**20}
+
+  def recycle(self):
+    """
+    Rebuilds the solver from the live clauses if it crossed one of the thresholds(see class doc). 
+    Does nothing while a scope is open. Returns True if the solver was rebuilt.
+
+    >>> x,_p_x = Ints('x _p_x')
+    >>> g = ConjFml()
+    >>> g.add([x >= 2, x <= 4])
+    >>> g.solver.push(); g.solver.add(_p_x == x + 1, _p_x >= 3, _p_x <= 5, x >= 0)
+    >>> g.recycle()
+    False
+    >>> g.solver.pop(); g.solver.add(x != 3, x != 5, x != 6)   # as if left behind by an unbalanced push/pop
+    >>> g.recycle(), g.recycled, g.solver_stats()['assertions']
+    (True, 1, 2)
+    """
+    if self.solver.num_scopes() != 1:
+      return False
+    stats = self.solver_stats()
+    ratio, conflicts, memory = ConjFml.max_assertion_ratio, ConjFml.max_conflicts, ConjFml.max_memory
+    if not ((ratio is not None and stats['assertions'] > ratio*max(len(self), 1)) or
+            (conflicts is not None and stats['conflicts'] > conflicts) or
+            (memory is not None and stats['memory'] > memory and stats['checks'] >= ConjFml.recycle_every)):
+      return False
+
+    self.solver = Solver()
+    self.solver.push()
+    self.solver.add(list(self))
+    self.recycled += 1
+    return True
+
+  def has(self, clause):
+    """
+    Syntactic membership check on canonical atoms, no solver involved.
+
+    >>> x,y = Ints('x y')
+    >>> g = ConjFml()
+    >>> g.add([Or(x < 8, y >= 2), y == 1])
+    >>> g.has(Or(2*y >= 3, x <= 7)), g.has(x <= 7)
+    (True, False)
+    """
+    return atom_table.clause_key(clause) in self.keys
+
   def difference(self, clauses):
     """
     returns a copy of self with the given clauses removed.(clauses is an iterable over formulas.) 
@@ -231,14 +325,14 @@ class ConjFml(Goal):
     [x >= 3, Not(y <= x)]
     """
     acc, newConj = [], ConjFml()
+    removed = set(map(atom_table.clause_key, clauses))
 
     for clause in self:
-      if clause not in clauses:
+      if atom_table.clause_key(clause) not in removed:
         acc.append(clause)
     
     newConj.add(acc)
     newConj.update_vars()
-    newConj.solver.add(acc)
     return newConj
 
   def as_primed(self):
@@ -294,7 +388,6 @@ class ConjFml(Goal):
     On appliying a tactic to a goal, the result is a list of subgoals s.t. the original goal is satisfiable iff at least one of the subgoals is satisfiable.
     i.e. disjunction of goals. But each subgoal may not be a conjuct of constraints. Applying this tactical splits subgoals such that each subgoal is a conjunct of atomic constraints. If input is in CNF then o/p is in DNF.
     """
-    propagate = Repeat(OrElse(Then(Tactic('propagate-ineqs'),Tactic('propagate-values')),Tactic('propagate-values')))  # Propagate inequalities and values.
     qe = Tactic('qe')           # Quantifier Elim.
     #TODO: Add solve-eqns tactic to do gaussian elimination after propagatoin.
 
@@ -308,20 +401,106 @@ class ConjFml(Goal):
     preimg = qe(Exists((allPrimedVars), And(self.as_expr(), trans, cube.as_primed().as_expr())))
     # preimg = qe(Exists((allPrimedVars), And(self, trans, Not(cube.as_expr()), cube.as_primed().as_expr())))
     
-    #Convert preimg to DNF without converting to CNF first.
-    preimg_dnf = []
-    for subgoal in preimg:
-      preimg_dnf.extend(to_DNF(subgoal.as_expr()))
-    
-    preimg_cubes = []
-    for cube in preimg_dnf:
-      preimg_cubes.extend(propagate(cube))
-
     #----- Check preimg <=> preimg_cubes -----
     # s = Solver()
     #----------------------------------------
 
-    return preimg_cubes
+    return goals_to_cubes(preimg)
+
+def goals_to_cubes(goals):
+  """
+  Converts goals(e.g. the subgoals returned by a tactic) to DNF without converting to CNF first, 
+  and propagates inequalities and values in each cube. Returns list of cubes as Goals.
+  """
+  propagate = Repeat(OrElse(Then(Tactic('propagate-ineqs'),Tactic('propagate-values')),Tactic('propagate-values')))  # Propagate inequalities and values.
+
+  dnf = []
+  for subgoal in goals:
+    dnf.extend(to_DNF(subgoal.as_expr()))
+
+  cubes = []
+  for cube in dnf:
+    cubes.extend(propagate(cube))
+  return cubes
+
+def functional_update(atom):
+  """
+  Returns (_p_v, t) if atom is _p_v == t(either way around) and t has no primed vars, None otherwise.
+  Such an atom is satisfiable for every valuation of the unprimed vars, and _p_v can be eliminated by substituting t.
+
+  >>> x,y,_p_x,_p_y = Ints('x y _p_x _p_y')
+  >>> functional_update(simplify(_p_x == x + y))
+  (_p_x, x + y)
+  >>> functional_update(_p_x == _p_y) is None
+  True
+  """
+  if not is_eq(atom):
+    return None
+  for lhs, rhs in [atom.children(), list(reversed(atom.children()))]:
+    if is_const(lhs) and str(lhs)[0:3] == '_p_' and all(str(var)[0:3] != '_p_' for var in get_vars(rhs)):
+      return lhs, rhs
+  return None
+
+class PartTrans(object):
+  """
+  Partitioned transition relation. Keeps the disjuncts of trans(in DNF) separate, each one guarded by its own selector 
+  literal _s_i, so that as_expr() is Or(_s_0, _s_1, ...) && (_s_0 => d_0) && (_s_1 => d_1) && ...
+  It can be asserted in place of trans, and a selector passed as an assumption to check() restricts a query to one disjunct.
+
+  Preimages are computed one disjunct at a time. Disjuncts with no transition into the cube are skipped with one 
+  check each. If every primed var of a disjunct is given by a functional update(see functional_update), its 
+  preimage is a plain substitution; only the remaining disjuncts go through qe.
+  """
+  def __init__(self, trans):
+    self.disjuncts = [list(cube) for cube in to_DNF(trans) if not any([is_false(atom) for atom in cube])]
+    self.selectors = [Bool('_s_%i' % i) for i in range(len(self.disjuncts))]
+    self.expr = And(Or(self.selectors), And([Implies(sel, And(d)) for sel, d in zip(self.selectors, self.disjuncts)]))
+
+  def __len__(self):
+    return len(self.disjuncts)
+
+  def as_expr(self):
+    return self.expr
+
+  def preimage(self, frame, cube):
+    """
+    Same as frame.preimage(cube, trans), but returns a list of (cube, i) where i is the disjunct that produced the cube.
+
+    >>> x,y,_p_x,_p_y = Ints('x y _p_x _p_y')
+    >>> T = PartTrans(Or(And(_p_x==x+2,x<8),And(_p_y==y-2,y>0),And(x==8,_p_x==0),And(y==0,_p_y==8)))
+    >>> F = ConjFml()
+    >>> F.add([x>=0,y>=0,y<=20,x<=20], update=True)
+    >>> cube = ConjFml()
+    >>> cube.add([x==4,y==4])
+    >>> T.preimage(F,cube)
+    [([x == 2, y >= 0, y <= 20], 0), ([x >= 0, x <= 20, y == 6], 1)]
+    """
+    if not cube.safe_varlist:
+      cube.update_vars()
+    primedCube = cube.as_primed().as_expr()
+
+    frame.solver.push()
+    frame.solver.add(self.expr)
+    live = [i for i, sel in enumerate(self.selectors) if frame.solver.check(sel, primedCube) == sat]
+    frame.solver.pop()
+
+    acc = []
+    for i in live:
+      subst, rest = {}, []
+      for atom in self.disjuncts[i]:
+        upd = functional_update(atom)
+        if upd is not None and str(upd[0]) not in subst:
+          subst[str(upd[0])] = upd
+        else:
+          rest.append(atom)
+      fml = And(frame.as_expr(), And(rest), primedCube)
+      if all(str(var) in subst for var in get_vars(fml) if str(var)[0:3] == '_p_'):
+        goal = Goal()
+        goal.add(substitute(fml, list(subst.values())))
+        acc.extend([(c, i) for c in goals_to_cubes([goal])])
+      else:
+        acc.extend([(c, i) for c in frame.preimage(cube, And(self.disjuncts[i]))])
+    return acc
 
 def powerset(iterable):
     """
@@ -331,10 +510,15 @@ def powerset(iterable):
     s = list(iterable)
     return itertools.chain.from_iterable(itertools.combinations(s, r) for r in range(1,len(s)+1))
 
-def generalize_unsat_minimum(init, frame, trans, cube):
+def generalize_unsat_minimum(init, frame, trans, cube, reach=None):
   """
   Takes the cube(as ConjFml) to be generalized and returns generalized cube. 
   i.e. Returns MINIMUM unsat core in the cube. Could do minimal, but then this may be more general.
+
+  reach is an optional simulate.Simulator. Candidates containing a state it has seen are reachable, 
+  so they are rejected without asking the solver.
+
+  The cube must not intersect init(such a cube is a counterexample, see block() in pdr.py), otherwise ValueError is raised.
   """
   s = Solver()
   s.add(init)
@@ -348,7 +532,8 @@ def generalize_unsat_minimum(init, frame, trans, cube):
     # print("Trying to gen: ", And(subset))
     gcube.add([And(subset)]) if len(subset) > 1 else gcube.add(subset)
     # print(gcube)
-    frame.solver.push()
+    if reach is not None and reach.hits(gcube):
+      continue
 
     s.pop() #remove prev gcube.
     s.push()
@@ -359,9 +544,10 @@ def generalize_unsat_minimum(init, frame, trans, cube):
       break
 
   frame.solver.pop() #remove trans
+  frame.recycle()
 
   if s.check() == sat:
-    exit("P not satisfied.")
+    raise ValueError("Cube %s intersects init, it can not be generalized." % cube)
 
   gcube = simplifyAll(gcube)
 
@@ -578,6 +764,63 @@ def to_DNF(fml):
   flatten(dnfFml)
   return final
 
+def state_vars(*fmls):
+  """
+  Returns list of unprimed variables occurring in fmls, in order of first occurrence and without dupes.
+  Primed variables(prefixed with "_p_") are skipped, so this gives the state variables of a transition system.
+
+  >>> x,y,_p_x = Ints('x y _p_x')
+  >>> state_vars(And(x==0,y==1), And(_p_x==x+1, x<8))
+  [x, y]
+  """
+  acc = []
+  for fml in fmls:
+    acc.extend([var for var in get_vars(fml) if str(var)[0:3] != '_p_'])
+  return list(dict.fromkeys(acc))
+
+def at_step(fml, svars, i):
+  """
+  Returns fml with every state variable x renamed to x@i and its primed version _p_x renamed to x@(i+1).
+  Used to unroll a transition system, e.g. at_step(T,svars,0), at_step(T,svars,1),... is the path s_0 -> s_1 -> s_2 ...
+
+  >>> x,y,_p_x = Ints('x y _p_x')
+  >>> at_step(And(_p_x==x+1, y<8), [x,y], 2)
+  And(x@3 == x@2 + 1, y@2 < 8)
+  """
+  now = Ints(["%s@%i" % (var, i) for var in svars])
+  nxt = Ints(["%s@%i" % (var, i+1) for var in svars])
+  primed = Ints(["_p_%s" % var for var in svars])
+  return substitute(fml, list(zip(svars, now)) + list(zip(primed, nxt)))
+
+def inductive_subset(init, trans, lemmas):
+  """
+  Houdini style filtering. Returns the largest subset of lemmas(list of BoolRef over unprimed vars) whose conjunction
+  holds in init and is inductive under trans, i.e. an inductive invariant. Lemmas violated in init are dropped first,
+  then any lemma not preserved by trans relative to the remaining ones is dropped until a fix-point is reached.
+
+  >>> x,y,_p_x,_p_y = Ints('x y _p_x _p_y')
+  >>> inductive_subset(And(x==0,y==0), And(_p_x==x+1,_p_y==y+x), [x>=0, x<=5, y>=0])
+  [x >= 0, y >= 0]
+  """
+  svars = state_vars(init, trans, *lemmas)
+  primed = list(zip(svars, Ints(["_p_%s" % var for var in svars])))
+
+  s = Solver()
+  s.add(init)
+  cands = [lem for lem in lemmas if s.check(Not(lem)) == unsat]
+
+  changed = True
+  while changed:
+    changed = False
+    s.reset()
+    s.add(trans)
+    s.add(cands)
+    for lem in list(cands):
+      if s.check(Not(substitute(lem, primed))) == sat:
+        cands.remove(lem)
+        changed = True
+  return cands
+
 #---------- For interactive testing ----------
 # x,y = Ints('x y')
 # g = ConjFml()
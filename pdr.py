@@ -1,5 +1,6 @@
 """
-This contains the main PDR algorithm as a function. 
+This contains the main PDR algorithm as a function, along with k-induction(kind) as an alternative engine.
+Both take the same inputs and return a Result.
 To test it, uncomment one of the examples provided in the "Input" section of the source and run: python3 pdr.py
 
 You may also add your own examples in the format demonstrated in the examples.
@@ -7,9 +8,18 @@ You may also add your own examples in the format demonstrated in the examples.
 To enable/disable verbose(intermediate) output set the do_debug variable below appropriately.(Enabled by default.)
 """
 from formula import *
+from preprocess import preprocess
+from checkpoint import save as save_trace, load as load_trace
+from certificate import write_certificate
 
 from sys import exit
 from heapq import heappush, heappop
+from time import time
+import os
+try:
+  from simulate import Simulator
+except ImportError: #numpy not installed, pdr(simulate=True) is unavailable.
+  Simulator = None
 
 do_debug = True
 
@@ -47,24 +57,145 @@ do_debug = True
 # # P_orig = And(k == 3*i, j == 2*i) #This is valid. 
 # P_orig = Or(l==0,k>3*i) #Use this to test push forward. Not valid.
 
+class Result(object):
+  """
+  Outcome of a verification run. Returned by pdr() and kind() alike.
+
+  valid is True if P holds in the system, False if it is violated and None if the engine gave up(bound reached).
+  msg is the verdict meant for humans. 
+  frames is the trace(list of ConjFml) at termination and is empty for kind(). 
+  invariant is the inductive invariant found(ConjFml), if any.
+  stats holds counters of the run, e.g. number of obligations handled and lemmas learnt by pdr().
+  """
+  def __init__(self, valid, msg, frames=None, invariant=None, stats=None):
+    self.valid = valid
+    self.msg = msg
+    self.frames = frames if frames is not None else []
+    self.invariant = invariant
+    self.stats = stats if stats is not None else {}
+
+  def __repr__(self):
+    return self.msg
+
+  def lemmas(self):
+    """
+    Returns clauses of all frames except Init, without dupes. 
+    Intended to be fed to kind() as candidate strengthening invariants.
+    """
+    acc = []
+    for frame in self.frames[1:]:
+      acc.extend(frame)
+    return list(dict.fromkeys(acc))
+
 #------------ PDR Main ------------
-def pdr(I, T, P):
+def pdr(I, T, P, max_frames=None, simulate=False, partition=False, checkpoint=None, checkpoint_every=300, resume=False, seed=[], trace=None, certificate=None):
   """
   Main PDR Algorithm.
 
   Contains propagation and blocking phase as nested functions. Look at source for more details.
+  If max_frames is given, gives up with an inconclusive Result once the frontier goes past it. 
+  Its lemmas can still be used to strengthen kind().
+
+  If simulate is set, random traces are simulated first(see simulate.py, needs numpy). A reachable !P state found that way
+  ends the run without any SMT call, and the cached reachable states are used to answer obligations and to prune
+  generalization candidates. Every state in an obligation cube reaches !P, so a reachable one is a counterexample.
+
+  If partition is set, T is kept as a PartTrans: solvers get its selector encoding and preimages are computed
+  per disjunct instead of running qe over the whole disjunction. Each obligation pushed from a preimage then records
+  the disjunct(index into PartTrans.disjuncts) that leads from it to its successor in .disjunct, e.g. to rebuild
+  the steps of a counterexample. It is None without partition.
+
+  If checkpoint(a file path) is given, the frames, obligation queue, n and stats are saved there every checkpoint_every 
+  seconds(see checkpoint.py). With resume set, a run starts from that checkpoint if the file exists; solvers are 
+  rebuilt from the saved lemmas and pending obligations are handled before the main loop goes on.
+  With checkpointing on, stats['seconds'] of the Result is the run time over all resumed runs.
+
+  seed is a list of lemmas(BoolRef) whose conjunction is an inductive invariant, e.g. as returned by cache.Cache.seeds().
+  They hold in every reachable state, so they are added to frame 1 up front; propagate() pushes them forward.
+
+  trace is an optional list of frames to work on in place instead of a new one(see pdr_multi). Its frames never
+  get P added to them, so lemmas learnt in it depend only on I and T and stay valid for other properties.
+
+  If certificate(a file path) is given, a SAFE answer writes the fix-point there as an SMT-LIB certificate over the
+  original T, which any SMT solver can re-check with three queries(see certificate.py).
+
+  >>> import pdr as engine
+  >>> engine.do_debug = False
+  >>> x,_p_x = Ints('x _p_x')
+  >>> I, T = x == 0, Or(And(x == 0, _p_x == 1), And(x == 1, _p_x == 1))
+  >>> res = pdr(I, T, to_ConjFml(x != 1))
+  >>> print(res.valid, res.msg)
+  False P not satisfied!
+    Obligation [x == 0] at level 1 intersects Init.
+  >>> pdr(I, T, to_ConjFml(x <= 1)).valid
+  True
   """
 
   comp = ConjFml()
   comp.add([z_false])
 
-  F1 = to_ConjFml(P_orig)
-  # F1 = ConjFml()
-  #Trace
-  frames = [to_ConjFml(I), F1]
+  if trace is None:
+    F1 = to_ConjFml(P.as_expr())
+    # F1 = ConjFml()
+    #Trace
+    frames = [to_ConjFml(I), F1]
+  else:
+    frames = trace
+  if seed:
+    frames[1].add(seed)
   #Proof obligation queue
   pQueue = []
   n = 1
+  stats = {'obligations': 0, 'lemmas': 0}
+  TS = T #T as given, before partitioning. Checkpoints are tied to it.
+
+  if resume and checkpoint is not None and os.path.exists(checkpoint):
+    frames, pQueue, n, stats = load_trace(checkpoint, I, TS, P.as_expr())
+    print("Resumed from %s at frame %i with %i obligations. Stats: %s" % (checkpoint, n, len(pQueue), stats)) if do_debug else print(end='')
+  start, elapsed, saved = time(), stats.get('seconds', 0.0), time()
+  queued = set([(level, atom_table.cube_key(cube)) for level, cube in pQueue]) #(level, cube key) of each obligation in pQueue.
+
+  def save():
+    """
+    Saves the trace state if checkpointing is on and checkpoint_every seconds have passed since the last save.
+    """
+    nonlocal saved
+    if checkpoint is None or time() - saved < checkpoint_every:
+      return
+    stats['seconds'] = elapsed + time() - start
+    save_trace(checkpoint, I, TS, P.as_expr(), frames, pQueue, n, stats)
+    saved = time()
+
+  def push(level, cube):
+    """
+    Queues obligation cube at level, unless a cube with the same literals is queued at level already.
+    """
+    key = (level, atom_table.cube_key(cube))
+    if key not in queued:
+      queued.add(key)
+      heappush(pQueue, (level, cube))
+
+  def finish(res):
+    """
+    Returns res, with the total run time in stats['seconds'] if checkpointing is on.
+    """
+    if checkpoint is not None:
+      stats['seconds'] = elapsed + time() - start
+    return res
+
+  sim = None
+  if simulate:
+    if Simulator is None:
+      raise ImportError("pdr(simulate=True) needs numpy.")
+    sim = Simulator(I, T, P.as_expr())
+    cex = sim.run()
+    if cex is not None:
+      return finish(Result(False, "P not satisfied!\n  Simulation reached %s." % cex, frames, stats=stats))
+
+  part = None
+  if partition:
+    part = PartTrans(T)
+    T = part.as_expr()
   
   def propagate(n):
     """
@@ -86,7 +217,12 @@ def pdr(I, T, P):
       frames[k].solver.push()
       frames[k].solver.add(T)
 
-      for clause in set(frames[k]) - set(frames[k+1]):
+      pending = {} #clauses of frames[k] not in frames[k+1], one per clause key.
+      for clause in frames[k]:
+        if not frames[k+1].has(clause):
+          pending.setdefault(atom_table.clause_key(clause), clause)
+
+      for clause in pending.values():
         primed_clause = frames[k].get_primed(clause)
         
         if frames[k].solver.check(Not(primed_clause)) == unsat:
@@ -100,74 +236,106 @@ def pdr(I, T, P):
         frames[k+1] = frames[k+1].difference(removeList)
         # ---- -------------------------------
       frames[k].solver.pop() #Remove TS
+      frames[k].recycle()
       
       frames[k+1] = to_ConjFml(frames[k+1].simplify().as_expr())
 
       if frames[k] == frames[k+1]:
         print("Frames: %s" % frames) if do_debug else print(end='')
-        exit("P is valid in the system!\n Fix-point is %s \n\n  Took %i propagations." % (frames[k],n))
+        if certificate is not None:
+          write_certificate(certificate, I, TS, P.as_expr(), frames[k])
+        return Result(True, "P is valid in the system!\n Fix-point is %s \n\n  Took %i propagations." % (frames[k],n), frames, frames[k], stats)
     
     print("Done. Frontier frame[%i] is now: %s" % (n+1, frames[n+1])) if do_debug else print(end='')
     
-    return
+    return None
 
   def block(cube, level):
     """
     Blocking phase of PDR. Takes cube as ConjFml.
+    Returns a Result if a counterexample is found, None once all obligations are blocked.
+    With cube None, only the obligations already queued are handled(used on resume).
+    Obligations are queued through push(), so a cube is queued at most once per level.
     """
     nonlocal pQueue, frames, n, comp
 
-    heappush(pQueue, (level, cube))
+    if cube is not None:
+      push(level, cube)
 
     while pQueue:
+      save()
       level, cube = heappop(pQueue)
+      queued.discard((level, atom_table.cube_key(cube)))
+      stats['obligations'] += 1
 
       if level == 0:
-        exit("P not satisfied!\n  Took %i propagations." % (n-1))
+        return Result(False, "P not satisfied!\n  Took %i propagations." % (n-1), frames, stats=stats)
+
+      if sim is not None and sim.hits(cube): #cube contains a reachable state.
+        return Result(False, "P not satisfied!\n  Simulation reached obligation %s at level %i." % (cube, level), frames, stats=stats)
       
       if frames[level].solver.check(cube.as_expr()) == unsat: #cube is blocked at level.
         continue             #look at next obligation.
 
       if frames[level-1].solver.check(Not(cube.as_expr()), T, cube.as_primed().as_expr()) == sat: #Note:cube is a ConjFml.
-        preimg = frames[level-1].preimage(cube,T)
+        if part is not None:
+          preimg = part.preimage(frames[level-1], cube)
+          print("Disjuncts producing preimage of %s: %s" % (cube, [i for _,i in preimg])) if do_debug else print(end='')
+        else:
+          preimg = [(preCube, None) for preCube in frames[level-1].preimage(cube,T)]
         
         print("pQueue: %s" % pQueue) if do_debug else print(end='')
 
-        preimg = [cub for cub in preimg if cub != comp]
+        preimg = [(cub, i) for cub, i in preimg if cub != comp]
         if preimg == []:
           continue
 
-        print("Preimage of %s in frame %s is: %s" % (cube, frames[level-1], preimg)) if do_debug else print(end='')
+        print("Preimage of %s in frame %s is: %s" % (cube, frames[level-1], [cub for cub,_ in preimg])) if do_debug else print(end='')
 
         # gPreCube = generalize_sat_minimum(I, preimg, preimg[0]) #pick a cube from preimg to generalize.
-        for preCube in preimg:
-          heappush(pQueue, (level-1, to_ConjFml(preCube.as_expr())))
-        heappush(pQueue, (level, cube))
+        for preCube, i in preimg:
+          obligation = to_ConjFml(preCube.as_expr())
+          obligation.disjunct = i
+          push(level-1, obligation)
+        push(level, cube)
+      elif frames[0].solver.check(cube.as_expr()) == sat: #cube has no predecessor, but contains an initial state.
+        return Result(False, "P not satisfied!\n  Obligation %s at level %i intersects Init." % (cube, level), frames, stats=stats)
       else:
-        genCube = generalize_unsat_minimum(I, frames[level-1], T, cube)
+        genCube = generalize_unsat_minimum(I, frames[level-1], T, cube, sim)
         
         print("%s is generalizedUNSAT to: %s" % (cube, genCube)) if do_debug else print(end='')
         
         for i in range(level,0,-1):
           blockingClause = to_NNF(Not(genCube.as_expr()))
-          if blockingClause in frames[level]: #syntactic check
+          if frames[i].has(blockingClause): #syntactic check
             break
           frames[i].add([blockingClause])
+          stats['lemmas'] += 1
         #---- Optional: Push fwd. ----
         # propagate(n+2) #+2 to prevent appending new frame.
         #-----------------------------
+    return None
 
   #---------- PDR Main Loop begins here ----------
 
   if frames[0].solver.check(Not(P.as_expr())) == sat:
-    exit("P not satisfied in Init.  \nTook %i propagations." % n-1)
+    return finish(Result(False, "P not satisfied in Init.  \nTook %i propagations." % (n-1), frames, stats=stats))
+
+  res = block(None, n) #Obligations left over in a resumed checkpoint.
+  if res is not None:
+    return finish(res)
 
   while True:
+    save()
 
     if frames[n].solver.check(Not(P.as_expr())) == unsat:
       # print("\nSolver: %s" % s) if do_debug else print(end='')
-      propagate(n)
+      res = propagate(n)
+      if res is not None:
+        return finish(res)
       n += 1
+      if max_frames is not None and n > max_frames:
+        return finish(Result(None, "Unknown: no fix-point within %i frames." % max_frames, frames, stats=stats))
     else:
       #------- Getting model as Boolref is ugly business! Why isn't there a built-in way to do this!?!? -------
       # model = s.model()
@@ -190,11 +358,157 @@ def pdr(I, T, P):
       for bCube in bad_cubes:
       # bCube = gCube
         print("\nCalling block(%s,%i)" % (bCube, n)) if do_debug else print(end='')
-        block(bCube, n)
+        res = block(bCube, n)
+        if res is not None:
+          return finish(res)
 
   #--------- End PDR Main -----------
 
-I = I_orig
-T = T_orig #T is typically in DNF?
-P = to_ConjFml(P_orig)
-pdr(I, T, P)
\ No newline at end of file
+def pdr_multi(I, T, props, max_frames=None, seed=[], **kwargs):
+  """
+  Verifies every property in props(list of ConjFml) over the same I, T, sharing one trace between all of them.
+  seed is added to the shared trace once(see pdr()). Other keyword arguments are passed on to pdr(), except 
+  checkpoint, resume and certificate, which belong to a single property and raise ValueError.
+
+  Properties are checked with pdr(trace=...). The shared frames never contain a property, so every lemma learnt 
+  for one property is reused by the others. When a fix-point is reached, all pending properties it implies are 
+  proved at once.
+  Properties are scheduled round robin with a frame budget that doubles every round, so that properties with 
+  shallow proofs are settled before deep counterexamples fill the trace with lemmas that only hold up to some depth.
+  max_frames caps the budget; properties still pending then get an inconclusive Result.
+
+  This is a generator: it yields (index in props, Result) as each property is proved or refuted, 
+  and refuted properties are dropped.
+
+  Sharing the trace is not a speed-up: every call of pdr() starts over at frame 1 and propagates the shared frames
+  again, and lemmas learnt for one property also slow down the solvers for the others. E.g. the 5 properties of the 
+  simple loop example take longer with pdr_multi() than with a pdr() run each. Use it for the single trace, for 
+  answers in the order properties are settled and for properties implied by a fix-point without a run of their own.
+
+  >>> import pdr as engine
+  >>> engine.do_debug = False
+  >>> x,_p_x = Ints('x _p_x')
+  >>> I, T = x == 0, And(x < 8, _p_x == x + 2)
+  >>> for i, res in pdr_multi(I, T, [to_ConjFml(p) for p in [x <= 9, x <= 5, x <= 20]]):
+  ...   print(i, res.valid, res.msg.splitlines()[1].strip())
+  0 True Fix-point is [x <= 9]
+  2 True Implied by the fix-point of property 0.
+  1 False Took 2 propagations.
+  >>> [(i, res.valid) for i, res in pdr_multi(I, T, [to_ConjFml(x <= 9)], max_frames=1)]
+  [(0, None)]
+  >>> next(pdr_multi(I, T, [to_ConjFml(x <= 9)], certificate="/tmp/cert.smt2"))
+  Traceback (most recent call last):
+  ...
+  ValueError: pdr_multi() does not support certificate.
+  """
+  for name in ["checkpoint", "resume", "certificate"]:
+    if kwargs.get(name):
+      raise ValueError("pdr_multi() does not support %s." % name)
+  trace = [to_ConjFml(I), ConjFml()]
+  if seed:
+    trace[1].add(seed)
+  pending = list(range(len(props)))
+  budget = 2 if max_frames is None else min(2, max_frames)
+
+  while pending:
+    for i in list(pending):
+      if i not in pending: #Proved by a fix-point found earlier in this round.
+        continue
+      res = pdr(I, T, props[i], max_frames=budget, trace=trace, **kwargs)
+      if res.valid is None:
+        if max_frames is not None and budget >= max_frames:
+          pending.remove(i)
+          yield i, res
+        continue
+
+      pending.remove(i)
+      if res.invariant is not None:
+        res.invariant = to_ConjFml(res.invariant.as_expr()) #The frame itself may still change.
+      yield i, res
+
+      if res.valid and res.invariant is not None:
+        for j in list(pending):
+          if res.invariant.solver.check(Not(props[j].as_expr())) == unsat:
+            pending.remove(j)
+            yield j, Result(True, "P is valid in the system!\n Implied by the fix-point of property %i." % i, trace, res.invariant)
+    budget = 2*budget if max_frames is None else min(2*budget, max_frames)
+
+#------------ k-Induction ------------
+def kind(I, T, P, max_k=None, lemmas=[]):
+  """
+  k-induction. Same inputs as pdr(), T uses "_p_" primed vars, P is a ConjFml.
+
+  For k = 0,1,2...
+    Base: SAT(I(s_0) && T(s_0,s_1) && ... && T(s_(k-1),s_k) && !P(s_k)) => P not satisfied.
+    Step: UNSAT(P(s_0) && ... && P(s_k) && T(s_0,s_1) && ... && T(s_k,s_(k+1)) && !P(s_(k+1))) => P is valid,
+          where s_0 ... s_(k+1) are pairwise distinct(simple path) so that every property is eventually k-inductive for finite systems.
+  Each case keeps one solver that is extended by a single step per iteration. !P is only passed as an assumption to check().
+
+  lemmas is an optional list of candidate strengthening invariants, e.g. pdr(I,T,P,max_frames=5).lemmas().
+  PDR lemmas only hold within some bound, so they are first filtered down to an inductive subset(see inductive_subset)
+  which is then asserted at every step of the step case.
+
+  >>> import pdr as engine
+  >>> engine.do_debug = False
+  >>> x,y,_p_x,_p_y = Ints('x y _p_x _p_y')
+  >>> I, T = x == 0, And(x < 8, _p_x == x + 2)
+  >>> res = kind(I, T, to_ConjFml(x <= 9))
+  >>> res.valid, res.invariant
+  (True, [x <= 9])
+  >>> kind(I, T, to_ConjFml(x <= 5)).msg
+  'P not satisfied!\\n  Counterexample of length 3.'
+
+  The self loop on x == 3 is unreachable but leads to !P, only simple paths rule it out:
+  >>> T = Or(And(x <= 1, _p_x == 1 - x), And(x == 3, Or(_p_x == 3, _p_x == 4)))
+  >>> res = kind(I, T, to_ConjFml(x != 4))
+  >>> res.msg, res.invariant
+  ('P is valid in the system!\\n  P is 3-inductive.', None)
+
+  y >= 1 is not k-inductive for any k(x may start very negative), but it is 1-inductive given x >= 0:
+  >>> I, T, P = And(x == 0, y == 1), And(_p_x == x + 1, _p_y == y + x), to_ConjFml(y >= 1)
+  >>> kind(I, T, P, max_k=5).msg
+  'Unknown: P is not 6-inductive.'
+  >>> res = kind(I, T, P, lemmas=[x >= 0, x <= 3]) #x <= 3 is not inductive and gets dropped.
+  >>> res.valid, res.invariant
+  (True, [y >= 1, x >= 0])
+  """
+  svars = state_vars(I, T, P.as_expr())
+  invs = inductive_subset(I, T, lemmas) if lemmas else []
+  print("Strengthening invariants: %s" % invs) if do_debug else print(end='')
+  inv = And(invs) if invs else z_true
+
+  base, step = Solver(), Solver()
+  base.add(at_step(I, svars, 0))
+  step.add(at_step(inv, svars, 0))
+
+  k = 0
+  while max_k is None or k <= max_k:
+    if base.check(Not(at_step(P.as_expr(), svars, k))) == sat:
+      return Result(False, "P not satisfied!\n  Counterexample of length %i." % k)
+    base.add(at_step(P.as_expr(), svars, k))
+    base.add(at_step(T, svars, k))
+
+    step.add(at_step(P.as_expr(), svars, k))
+    step.add(at_step(T, svars, k))
+    step.add(at_step(inv, svars, k+1))
+    state = [at_step(var, svars, k+1) for var in svars]
+    for j in range(k+1):
+      step.add(Or([a != b for a,b in zip([at_step(var, svars, j) for var in svars], state)]))
+
+    if step.check(Not(at_step(P.as_expr(), svars, k+1))) == unsat:
+      #Only a 1-inductive P(with the invariants) is itself an inductive invariant.
+      invariant = to_ConjFml(And(P.as_expr(), inv)) if k == 0 else None
+      return Result(True, "P is valid in the system!\n  P is %i-inductive." % (k+1), [], invariant)
+
+    print("P is not %i-inductive." % (k+1)) if do_debug else print(end='')
+    k += 1
+
+  return Result(None, "Unknown: P is not %i-inductive." % (max_k+1))
+
+if __name__ == "__main__":
+  I, T, P = I_orig, T_orig, P_orig
+  # I, T, P = preprocess(I_orig, T_orig, P_orig) #Slice away everything that can not affect P. Not always faster, see preprocess.py.
+  P = to_ConjFml(P)
+  exit(pdr(I, T, P).msg) #Pass certificate="cert.smt2" to keep a proof, check it with: python3 certificate.py cert.smt2
+  # for i, res in pdr_multi(I_orig, T_orig, [to_ConjFml(p) for p in [P_orig]]): print(i, res.msg) #List several properties to share one trace.
+  # exit(kind(I, T, P).msg) #k-induction instead. Pass lemmas=pdr(I, T, P, max_frames=3).lemmas() to strengthen it.
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""
+Preprocessing of a transition system (I, T, P) before it is handed to pdr() or kind().
+
+Every query of pdr() carries T, and preimage() quantifies over all its primed vars, so anything that can not affect P
+only makes queries more expensive. preprocess() works on the disjuncts of T(in DNF) and:
+  1. Drops disjuncts that are trivially False.
+  2. Propagates constants: a var that is never updated(_p_v == v in every disjunct) and fixed by Init(v == c) is replaced by c.
+  3. Slices T, I and the variables down to the cone of influence of P.
+  4. Hoists frame-invariant equalities(_p_v == v in every disjunct) out of the disjunction.
+All steps are exact, so the verdict on the result is the verdict on the original system.
+Smaller queries do not mean a shorter run though: the lemmas PDR finds depend on the vars it sees, and on simple_vardep
+with P = Or(l==0, k>3*i) slicing away j makes pdr() handle about three times as many obligations. So it is opt-in.
+
+To run automated tests using doctest, do: python3 -m doctest preprocess.py [-v]
+"""
+
+from formula import *
+
+def _names(fml):
+  """
+  Returns set of variable names in fml, with primed names mapped back to unprimed ones.
+  """
+  return set([str(var)[3:] if str(var)[0:3] == '_p_' else str(var) for var in get_vars(fml)])
+
+def _identity(atom):
+  """
+  Returns v if atom is _p_v == v(either way around), None otherwise.
+  """
+  if not is_eq(atom):
+    return None
+  lhs, rhs = [str(child) for child in atom.children()]
+  if lhs == '_p_' + rhs:
+    return rhs
+  if rhs == '_p_' + lhs:
+    return lhs
+  return None
+
+def _update(atom):
+  """
+  Returns v if atom is a functional update of _p_v(see functional_update), None otherwise.
+  """
+  upd = functional_update(atom)
+  return str(upd[0])[3:] if upd is not None else None
+
+def frozen_vars(cubes):
+  """
+  Returns names of vars that keep their value in every disjunct(cubes as returned by to_DNF).
+
+  >>> x,k,_p_x,_p_k = Ints('x k _p_x _p_k')
+  >>> frozen_vars(to_DNF(And(_p_k == k, Or(And(x < k, _p_x == x + 1), And(x >= k, _p_x == x)))))
+  ['k']
+  """
+  common = None
+  for cube in cubes:
+    ids = set([_identity(atom) for atom in cube]) - set([None])
+    common = ids if common is None else common & ids
+  return sorted(common) if common else []
+
+def cone_of_influence(I, cubes, P):
+  """
+  Returns set of names of vars that may affect P. Starting from the vars of P, a var joins the cone if it occurs in
+  a guard(atom without primed vars), in an atom constraining a primed var of the cone, in an atom that is not a
+  functional update(those may disable a disjunct) or in a clause of I together with a var of the cone.
+
+  >>> i,j,k,l,_p_i,_p_j,_p_k,_p_l = Ints('i j k l _p_i _p_j _p_k _p_l')
+  >>> T = Or(And(l==0,Or(And(k<100,_p_i==i+1,_p_j==j+2,_p_k==k+3,_p_l==l),And(k>=100,_p_i==i,_p_j==j,_p_k==k,_p_l==1))), And(l==1,_p_i==i,_p_j==j,_p_k==k,_p_l==l))
+  >>> sorted(cone_of_influence(And(i==0,j==0,k==0,l==0), to_DNF(T), Or(l==0,k>3*i)))
+  ['i', 'k', 'l']
+  """
+  cone = _names(P)
+  init = to_ConjFml(I)
+
+  changed = True
+  while changed:
+    size = len(cone)
+    for cube in cubes:
+      updated = set()
+      for atom in cube:
+        v = _update(atom)
+        if v is not None and v not in updated and v not in cone:
+          updated.add(v)
+          continue
+        cone |= _names(atom)
+    for clause in init:
+      if _names(clause) & cone:
+        cone |= _names(clause)
+    changed = len(cone) != size
+  return cone
+
+def preprocess(I, T, P):
+  """
+  Returns (I, T, P) as BoolRefs, simplified as described in the module docstring.
+
+  >>> i,j,k,l,_p_i,_p_j,_p_k,_p_l = Ints('i j k l _p_i _p_j _p_k _p_l')
+  >>> T = Or(And(l==0,Or(And(k<100,_p_i==i+1,_p_j==j+2,_p_k==k+3,_p_l==l),And(k>=100,_p_i==i,_p_j==j,_p_k==k,_p_l==1))), And(l==1,_p_i==i,_p_j==j,_p_k==k,_p_l==l))
+  >>> I, T, P = preprocess(And(i==0,j==0,k==0,l==0), T, Or(l==0,k>3*i))
+  >>> state_vars(I, T, P)
+  [i, k, l]
+  >>> x,c,n,_p_x,_p_c,_p_n = Ints('x c n _p_x _p_c _p_n')
+  >>> I, T, P = preprocess(And(x==0,c==5,n>=0), Or(And(x<n,_p_x==x+c,_p_c==c,_p_n==n),And(x>=n,_p_x==0,_p_c==c,_p_n==n)), x>=0)
+  >>> I
+  And(x == 0, n >= 0)
+  >>> T
+  And(_p_n == n,
+      Or(And(Not(n <= x), _p_x == 5 + x),
+         And(x >= n, _p_x == 0)))
+  """
+  dead = lambda cube: any([is_false(atom) for atom in cube])
+  cubes = [list(cube) for cube in to_DNF(T) if not dead(cube)]
+  init = list(to_ConjFml(I))
+
+  #Constants: frozen vars fixed by an equality in Init.
+  consts = []
+  for v in frozen_vars(cubes):
+    for clause in init:
+      if is_eq(clause) and v in [str(child) for child in clause.children()]:
+        val = [child for child in clause.children() if is_int_value(child)]
+        if val:
+          consts.extend([(Int(v), val[0]), (Int('_p_' + v), val[0])])
+          break
+  if consts:
+    subst = lambda fmls: [atom for atom in [simplify(substitute(fml, consts)) for fml in fmls] if not is_true(atom)]
+    cubes = [cube for cube in map(subst, cubes) if not dead(cube)]
+    init = subst(init)
+    P = simplify(substitute(P, consts))
+
+  #Cone of influence. Only functional updates of vars outside the cone get dropped from T.
+  cone = cone_of_influence(And(init) if init else z_true, cubes, P)
+  cubes = [[atom for atom in cube if _names(atom) <= cone] for cube in cubes]
+  dropped = [clause for clause in init if not _names(clause) <= cone]
+  if Solver().check(dropped) == sat: #O/w Init is empty, keep it so that it stays empty.
+    init = [clause for clause in init if _names(clause) <= cone]
+
+  #Hoist frame-invariant equalities.
+  frozen = frozen_vars(cubes)
+  cubes = [[atom for atom in cube if _identity(atom) not in frozen] for cube in cubes]
+  disjuncts = [And(cube) if cube else z_true for cube in cubes]
+  disj = z_false if not disjuncts else disjuncts[0] if len(disjuncts) == 1 else Or(disjuncts)
+  T = And([Int('_p_' + v) == Int(v) for v in frozen] + [disj]) if frozen else disj
+
+  I = And(init) if init else z_true
+  return I, T, P
@@ -0,0 +1,375 @@
+"""
+Long-running verification service, so that many small problems do not each pay for interpreter start, importing Z3
+and the module level work of formula.py.
+
+The server listens on a Unix socket(default) or a localhost TCP port and keeps a bounded pool of worker processes,
+each of which imports the engine once and then solves problems one after the other. Processes rather than threads,
+since Z3 holds the GIL and a running job can only be cancelled by killing its worker(which is then restarted).
+
+Protocol: one JSON object per line in each direction. Requests on a connection are queued in order and run
+concurrently on the pool, so a client may send a whole batch up front; answers come back as jobs finish.
+  {"id": 1, "declarations": "(declare-fun x () Int)(declare-fun _p_x () Int)",
+   "init": "(= x 0)", "trans": "(and (< x 8) (= _p_x (+ x 2)))", "prop": "(<= x 9)",
+   "engine": "pdr", "preprocess": false, "timeout": 60, "options": {"max_frames": 50}}
+      init, trans and prop are SMT-LIB terms, primed variables are named _p_<var> as everywhere else.
+      engine is "pdr"(default) or "kind". options are passed on to it as keyword arguments, only those listed in
+      allowed_options are accepted(nothing that makes the server read or write files).
+      timeout(seconds, optional) cancels the job when it runs longer.
+  {"cancel": 1}
+      Cancels job 1 of this connection, whether it is still queued or running.
+Answers are {"id": 1, "valid": true/false/null, "msg": ..., "invariant": [SMT-LIB clauses] or null, "seconds": ...}
+or {"id": 1, "error": ...}, e.g. "cancelled", "timeout", "Bad request: ..." or a parse error. Jobs of a connection that closes are cancelled.
+A request line longer than the line limit of the server(64 MiB by default) is skipped and answered with
+{"id": null, "error": "Bad request: line too long"}.
+
+To start the server, do: python3 server.py [--socket PATH | --port N] [--workers N] [--cache DIR]
+To run automated tests using doctest, do: python3 -m doctest server.py [-v]
+"""
+
+from pdr import *
+from cache import Cache, cached_pdr
+from checkpoint import parse_clauses
+from atoms import table as atom_table
+
+import pdr as engine #For engine.do_debug, which must be changed in each worker.
+
+import argparse
+import asyncio
+import json
+import socket
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+
+#Workers are forked from a clean, single threaded process that has already imported the engine, so that the ones
+#restarted after a cancellation start warm too.
+context = multiprocessing.get_context("forkserver")
+context.set_forkserver_preload(["pdr", "cache"])
+
+default_socket = os.path.join(os.path.expanduser("~"), ".cache", "pdr-lia", "server.sock")
+
+allowed_options = {
+  "pdr": {"max_frames": int, "simulate": bool, "partition": bool},
+  "kind": {"max_k": int, "lemmas": list}, #lemmas as SMT-LIB terms.
+}
+
+def bad_request(req):
+  """
+  Returns why req(a decoded request line) can not be queued as a job, None if it can.
+
+  >>> job = {"id": 1, "init": "(= x 0)", "trans": "(= _p_x x)", "prop": "(<= x 9)"}
+  >>> bad_request(job) is None, bad_request(dict(job, engine="kind", options={"max_k": 3}, timeout=2.5)) is None
+  (True, True)
+  >>> bad_request(dict(job, timeout="5"))
+  'timeout must be a positive number'
+  >>> bad_request(dict(job, options={"checkpoint": "/tmp/x"}))
+  'option checkpoint is not allowed for engine pdr'
+  >>> bad_request(dict(job, options={"max_frames": True}))
+  'option max_frames must be of type int'
+  >>> bad_request(dict(job, id=[1]))
+  'id must be a string or an integer'
+  """
+  if not isinstance(req, dict):
+    return "request must be a JSON object"
+  if not isinstance(req.get("id"), (str, int)) or isinstance(req.get("id"), bool):
+    return "id must be a string or an integer"
+  for key in ["init", "trans", "prop"]:
+    if not isinstance(req.get(key), str):
+      return "%s must be an SMT-LIB term" % key
+  if not isinstance(req.get("declarations", ""), str):
+    return "declarations must be SMT-LIB text"
+  engine_name = req.get("engine", "pdr")
+  if engine_name not in allowed_options:
+    return "unknown engine %s" % engine_name
+  timeout = req.get("timeout")
+  if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0):
+    return "timeout must be a positive number"
+  if not isinstance(req.get("preprocess", False), bool):
+    return "preprocess must be a boolean"
+  options = req.get("options", {})
+  if not isinstance(options, dict):
+    return "options must be a JSON object"
+  for name, value in options.items():
+    expected = allowed_options[engine_name].get(name)
+    if expected is None:
+      return "option %s is not allowed for engine %s" % (name, engine_name)
+    if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+      return "option %s must be of type %s" % (name, expected.__name__)
+    if expected is list and not all([isinstance(lemma, str) for lemma in value]):
+      return "option %s must be a list of SMT-LIB terms" % name
+  return None
+
+def solve(job, cache=None):
+  """
+  Solves one job(a request as a dict) and returns its answer as a dict. Runs in a worker process.
+  If cache(a Cache) is given, pdr jobs go through cached_pdr().
+
+  >>> engine.do_debug = False
+  >>> job = {"id": 1, "declarations": "(declare-fun x () Int)(declare-fun _p_x () Int)",
+  ...        "init": "(= x 0)", "trans": "(and (< x 8) (= _p_x (+ x 2)))", "prop": "(<= x 9)"}
+  >>> res = solve(job)
+  >>> res["id"], res["valid"], res["invariant"] is not None
+  (1, True, True)
+  >>> solve(dict(job, prop="(<= x 5)", engine="kind"))["valid"]
+  False
+  >>> solve(dict(job, prop="(<= y 9)"))["error"] # doctest: +ELLIPSIS
+  'Z3Exception: ...unknown constant y...'
+  >>> solve(dict(job, options={"certificate": "/tmp/cert.smt2"}))["error"]
+  'Bad request: option certificate is not allowed for engine pdr'
+  """
+  start = time()
+  error = bad_request(job)
+  if error is not None:
+    return {"id": job.get("id") if isinstance(job, dict) else None, "error": "Bad request: %s" % error}
+  try:
+    decls = job.get("declarations", "")
+    I, T, P = [parse_clauses(decls, [job[key]]).as_expr() for key in ["init", "trans", "prop"]]
+    if job.get("preprocess"):
+      I, T, P = preprocess(I, T, P)
+    P = to_ConjFml(P)
+
+    name, options = job.get("engine", "pdr"), dict(job.get("options", {}))
+    if "lemmas" in options:
+      options["lemmas"] = list(parse_clauses(decls, options["lemmas"]))
+    if name == "pdr" and cache is not None:
+      res = cached_pdr(I, T, P, cache, **options)
+    else:
+      res = (pdr if name == "pdr" else kind)(I, T, P, **options)
+  except Exception as e:
+    return {"id": job.get("id"), "error": "%s: %s" % (type(e).__name__, e)}
+
+  return {"id": job.get("id"), "valid": res.valid, "msg": res.msg,
+          "invariant": [clause.sexpr() for clause in res.invariant] if res.invariant is not None else None,
+          "seconds": time() - start}
+
+def work(conn, cache_dir):
+  """
+  Worker process main loop: solves the jobs received on conn(a Pipe end) until None or EOF.
+  """
+  engine.do_debug = False
+  cache = Cache(cache_dir) if cache_dir is not None else None
+  while True:
+    try:
+      job = conn.recv()
+    except EOFError:
+      return
+    if job is None:
+      return
+    conn.send(solve(job, cache))
+    atom_table.clear() #Nothing of the job is kept, so its atoms need not be either.
+
+class Worker(object):
+  """
+  A worker process and the parent end of its pipe.
+  """
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir
+    self.start()
+
+  def start(self):
+    self.conn, child = context.Pipe()
+    self.proc = context.Process(target=work, args=(child, self.cache_dir), daemon=True)
+    self.proc.start()
+    child.close() #So that recv() gets EOF once the worker dies.
+
+  def kill(self):
+    self.proc.kill()
+
+  def restart(self):
+    self.kill()
+    self.proc.join()
+    self.conn.close()
+    self.start()
+
+class Server(object):
+  """
+  Job queue and worker pool. queue_size bounds the number of queued jobs, reading from clients pauses when it is full.
+  line_limit bounds the length of a request line in bytes(problems are sent inline, so it is generous).
+  """
+  def __init__(self, workers=None, cache_dir=None, queue_size=10000, line_limit=2**26):
+    self.workers = [Worker(cache_dir) for i in range(workers or os.cpu_count() or 1)]
+    self.queue_size = queue_size
+    self.line_limit = line_limit
+    self.pending = {}   #(connection, id) -> job, for queued and running jobs.
+    self.running = {}   #(connection, id) -> Worker
+    self.cancelled = set()
+    self.waiters = ThreadPoolExecutor(len(self.workers)) #One thread per worker blocks on its pipe.
+
+  async def reply(self, writer, answer):
+    if writer.is_closing():
+      return
+    writer.write((json.dumps(answer) + "\n").encode())
+    try:
+      await writer.drain()
+    except ConnectionError:
+      pass
+
+  def cancel(self, key):
+    """
+    Cancels a queued or running job. Returns False if there is no such job.
+    """
+    if key not in self.pending:
+      return False
+    self.cancelled.add(key)
+    if key in self.running:
+      self.running[key].kill() #The dispatcher sees EOF, answers and restarts the worker.
+    return True
+
+  async def dispatch(self, worker):
+    """
+    Feeds queued jobs to worker, one at a time.
+    """
+    while True:
+      key, writer = await self.queue.get()
+      job = self.pending[key]
+      if key in self.cancelled:
+        self.cancelled.discard(key)
+        del self.pending[key]
+        await self.reply(writer, {"id": job["id"], "error": "cancelled"})
+        continue
+
+      self.running[key] = worker
+      try:
+        answer = await self.run(worker, key, job)
+      except Exception as e: #A bad job must not take the worker out of the pool.
+        worker.restart()
+        answer = {"id": job["id"], "error": "%s: %s" % (type(e).__name__, e)}
+      finally:
+        del self.running[key]
+        del self.pending[key]
+        self.cancelled.discard(key)
+      await self.reply(writer, answer)
+
+  async def run(self, worker, key, job):
+    """
+    Runs job on worker and returns its answer. Kills and restarts the worker if the job is cancelled or times out.
+    """
+    loop = asyncio.get_running_loop()
+    recv = loop.run_in_executor(self.waiters, worker.conn.recv)
+    error = None
+    try:
+      worker.conn.send(job)
+      answer = await asyncio.wait_for(asyncio.shield(recv), job.get("timeout"))
+    except asyncio.TimeoutError:
+      error = "timeout"
+    except (EOFError, OSError):
+      error = "cancelled" if key in self.cancelled else "worker died"
+    if error is not None:
+      worker.kill()
+      try:
+        await recv
+      except (EOFError, OSError):
+        pass
+      worker.restart()
+      answer = {"id": job["id"], "error": error}
+    return answer
+
+  async def readline(self, reader):
+    """
+    Returns the next line of reader, b"" at EOF. A line longer than line_limit is skipped and None returned.
+    """
+    try:
+      return await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError as e: #Last line without newline.
+      return e.partial
+    except asyncio.LimitOverrunError:
+      pass
+    while True: #Drop the rest of the line, without buffering more than line_limit of it.
+      try:
+        await reader.readuntil(b"\n")
+        return None
+      except asyncio.LimitOverrunError as e:
+        await reader.readexactly(e.consumed)
+      except asyncio.IncompleteReadError:
+        return None
+
+  async def handle(self, reader, writer):
+    """
+    Reads the requests of one connection.
+    """
+    keys = []
+    try:
+      while True:
+        line = await self.readline(reader)
+        if line == b"":
+          break
+        if line is None:
+          await self.reply(writer, {"id": None, "error": "Bad request: line too long"})
+          continue
+        try:
+          req = json.loads(line)
+          if "cancel" in req:
+            if not self.cancel((id(writer), req["cancel"])):
+              await self.reply(writer, {"id": req["cancel"], "error": "no such job"})
+            continue
+          error = bad_request(req)
+          if error is not None:
+            await self.reply(writer, {"id": req.get("id") if isinstance(req, dict) else None, "error": "Bad request: %s" % error})
+            continue
+          key = (id(writer), req["id"])
+        except (ValueError, KeyError, TypeError) as e:
+          await self.reply(writer, {"id": None, "error": "Bad request: %s" % e})
+          continue
+        if key in self.pending:
+          await self.reply(writer, {"id": req["id"], "error": "duplicate id"})
+          continue
+        self.pending[key] = req
+        keys.append(key)
+        await self.queue.put((key, writer))
+    except ConnectionError:
+      pass
+    finally:
+      for key in keys:
+        self.cancel(key)
+      writer.close()
+
+  async def serve(self, path=None, port=None):
+    """
+    Serves on the Unix socket at path, or on localhost:port if port is given, until cancelled.
+    """
+    self.queue = asyncio.Queue(self.queue_size)
+    tasks = [asyncio.create_task(self.dispatch(worker)) for worker in self.workers]
+    if port is not None:
+      server = await asyncio.start_server(self.handle, "127.0.0.1", port, limit=self.line_limit)
+    else:
+      path = path or default_socket
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      if os.path.exists(path):
+        os.remove(path)
+      server = await asyncio.start_unix_server(self.handle, path, limit=self.line_limit)
+    print("Serving on %s with %i workers." % (port or path, len(self.workers))) if engine.do_debug else print(end='')
+    try:
+      async with server:
+        await server.serve_forever()
+    finally:
+      for task in tasks:
+        task.cancel()
+      for worker in self.workers:
+        worker.kill()
+
+def client(jobs, path=None, port=None):
+  """
+  Sends jobs(list of request dicts) to a running server as one batch and yields the answers as they arrive.
+  """
+  if port is not None:
+    sock = socket.create_connection(("127.0.0.1", port))
+  else:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path or default_socket)
+  with sock, sock.makefile("rw") as f:
+    for job in jobs:
+      f.write(json.dumps(job) + "\n")
+    f.flush()
+    for i in range(len(jobs)):
+      yield json.loads(f.readline())
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="PDR-LIA verification server.")
+  parser.add_argument("--socket", help="Unix socket path(default %s)." % default_socket)
+  parser.add_argument("--port", type=int, help="Listen on localhost:PORT instead of a Unix socket.")
+  parser.add_argument("--workers", type=int, help="Number of worker processes(default: number of CPUs).")
+  parser.add_argument("--cache", help="Cache directory for cache.cached_pdr(default: no cache).")
+  args = parser.parse_args()
+  try:
+    asyncio.run(Server(args.workers, args.cache).serve(args.socket, args.port))
+  except KeyboardInterrupt:
+    pass
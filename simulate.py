@@ -0,0 +1,242 @@
+"""
+Concrete simulation of transition systems, used to falsify properties and prune lemma candidates without SMT calls.
+
+Linear atoms of I, P and of every disjunct of T(in DNF) are compiled into NumPy evaluators that work on a whole batch
+of states at once. A state is a row of an int64 array, with one column per state variable.
+Each disjunct of T is split into a guard(atoms over unprimed vars), updates(_p_x == linear term over unprimed vars)
+and checks(any other atom with primed vars). Primed vars without an update are havoced.
+
+Prereqs: pip3 install numpy
+
+To run automated tests using doctest, do: python3 -m doctest simulate.py [-v]
+"""
+
+from formula import *
+
+import numpy as np
+
+_comparisons = [(is_le, np.less_equal), (is_lt, np.less), (is_ge, np.greater_equal), (is_gt, np.greater),
+                (is_eq, np.equal), (is_distinct, np.not_equal)]
+
+def linear(term, index):
+  """
+  Returns (coeffs, const) s.t. term == coeffs.vars + const, where index maps variable names to columns.
+  Raises ValueError if term is not linear or has a variable not in index.
+
+  >>> x,y = Ints('x y')
+  >>> linear(2*x - (y - 3)*4, {'x':0,'y':1})
+  (array([ 2, -4]), 12)
+  >>> linear(x*y, {'x':0,'y':1})
+  Traceback (most recent call last):
+  ...
+  ValueError: Non-linear term x*y
+  """
+  if is_int_value(term):
+    return np.zeros(len(index), dtype=np.int64), term.as_long()
+  elif is_const(term):
+    if str(term) not in index:
+      raise ValueError("Unknown variable %s" % term)
+    coeffs = np.zeros(len(index), dtype=np.int64)
+    coeffs[index[str(term)]] = 1
+    return coeffs, 0
+  elif is_add(term):
+    parts = [linear(child, index) for child in term.children()]
+    return sum(c for c,_ in parts), sum(k for _,k in parts)
+  elif is_sub(term):
+    parts = [linear(child, index) for child in term.children()]
+    return parts[0][0] - sum(c for c,_ in parts[1:]), parts[0][1] - sum(k for _,k in parts[1:])
+  elif is_app_of(term, Z3_OP_UMINUS):
+    coeffs, const = linear(term.children()[0], index)
+    return -coeffs, -const
+  elif is_mul(term):
+    parts = [linear(child, index) for child in term.children()]
+    varying = [(c,k) for c,k in parts if c.any()]
+    if len(varying) > 1:
+      raise ValueError("Non-linear term %s" % term)
+    factor = 1
+    for c,k in parts:
+      if not c.any():
+        factor *= k
+    coeffs, const = varying[0] if varying else (np.zeros(len(index), dtype=np.int64), 1)
+    return coeffs*factor, const*factor
+  else:
+    raise ValueError("Non-linear term %s" % term)
+
+def compile_fml(fml, index):
+  """
+  Compiles a quantifier free LIA formula into a function that evaluates it on every row of an int64 array.
+  Raises ValueError for anything outside linear integer arithmetic.
+
+  >>> x,y = Ints('x y')
+  >>> f = compile_fml(Or(x < y, Not(x != 3)), {'x':0,'y':1})
+  >>> f(np.array([[1,2],[3,0],[4,4]]))
+  array([ True,  True, False])
+  """
+  if is_true(fml):
+    return lambda X: np.ones(len(X), dtype=bool)
+  elif is_false(fml):
+    return lambda X: np.zeros(len(X), dtype=bool)
+  elif is_and(fml):
+    fs = [compile_fml(child, index) for child in fml.children()]
+    return lambda X: np.logical_and.reduce([f(X) for f in fs])
+  elif is_or(fml):
+    fs = [compile_fml(child, index) for child in fml.children()]
+    return lambda X: np.logical_or.reduce([f(X) for f in fs])
+  elif is_not(fml):
+    f = compile_fml(fml.children()[0], index)
+    return lambda X: ~f(X)
+  elif is_implies(fml):
+    f, g = [compile_fml(child, index) for child in fml.children()]
+    return lambda X: ~f(X) | g(X)
+
+  for is_op, op in _comparisons:
+    if is_op(fml) and len(fml.children()) == 2 and is_int(fml.children()[0]):
+      lhs, rhs = [linear(child, index) for child in fml.children()]
+      coeffs, const = lhs[0] - rhs[0], lhs[1] - rhs[1]
+      return lambda X: op(X.dot(coeffs) + const, 0)
+  raise ValueError("Unsupported formula %s" % fml)
+
+class Simulator(object):
+  """
+  Simulates batches of random traces of (I, T) and caches the reachable states seen.
+  I and P must be BoolRef, T must use "_p_" primed vars like everywhere else.
+  If any of them can not be compiled(non-linear, non-integer), simulation is disabled: run() finds nothing
+  and hits() is always False.
+
+  >>> x,y,_p_x,_p_y = Ints('x y _p_x _p_y')
+  >>> T = Or(And(x < 8, _p_x == x + 2, _p_y == y - 2), And(x == 8, _p_x == 0, _p_y == 8))
+  >>> Simulator(And(x==0,y==8), T, Not(And(x==4,y==4)), traces=8, depth=10).run()
+  [x == 4, y == 4]
+  >>> sim = Simulator(And(x==0,y==8), T, x != 5, traces=8, depth=10)
+  >>> sim.run()
+  >>> sim.hits(And(x >= 6, y <= 2))
+  True
+  >>> sim.hits(x == 3)
+  False
+  """
+  def __init__(self, I, T, P, traces=1024, depth=64, inits=32, havoc=100, seed=0):
+    self.I = I
+    self.svars = state_vars(I, T, P)
+    self.index = {str(var): i for i,var in enumerate(self.svars)}
+    self.traces, self.depth, self.inits, self.havoc = traces, depth, inits, havoc
+    self.rng = np.random.default_rng(seed)
+    self.states = np.zeros((0, len(self.svars)), dtype=np.int64)
+    self.counterexample = None
+
+    try:
+      self.prop = compile_fml(P, self.index)
+      self.disjuncts = [self._compile_disjunct(cube) for cube in to_DNF(T)]
+    except ValueError: #Can not simulate this system.
+      self.disjuncts = []
+
+  def _compile_disjunct(self, cube):
+    """
+    Splits cube(a disjunct of T in DNF) into (guard, updates, check). updates maps a column to (coeffs, const).
+    """
+    d = len(self.svars)
+    index2 = dict(self.index)
+    index2.update({"_p_%s" % var: d+i for i,var in enumerate(self.svars)})
+
+    guards, updates, checks = [], {}, []
+    for atom in cube:
+      primed = [str(var) for var in get_vars(atom) if str(var)[0:3] == '_p_']
+      if not primed:
+        guards.append(atom)
+        continue
+      if is_eq(atom) and len(primed) == 1 and index2.get(primed[0], -1) - d not in updates:
+        lhs, rhs = [linear(child, index2) for child in atom.children()]
+        coeffs, const = lhs[0] - rhs[0], lhs[1] - rhs[1]
+        col = index2[primed[0]]
+        if coeffs[col] in (1, -1): # x' = -(a.x + c)/coef
+          sign = coeffs[col]
+          coeffs[col] = 0
+          updates[col-d] = (-sign*coeffs[:d], -sign*const)
+          continue
+      checks.append(atom)
+
+    guard = compile_fml(And(guards), self.index) if guards else compile_fml(z_true, self.index)
+    check = compile_fml(And(checks), index2) if checks else None
+    return guard, updates, check
+
+  def _init_states(self):
+    """
+    Returns up to self.inits distinct initial states, obtained from the solver. These are the only SMT calls made.
+    """
+    s = Solver()
+    s.add(self.I)
+    acc = []
+    while len(acc) < self.inits and s.check() == sat:
+      model = s.model()
+      vals = [model.eval(var, model_completion=True).as_long() for var in self.svars]
+      acc.append(vals)
+      s.add(Or([var != val for var,val in zip(self.svars, vals)]))
+    return np.array(acc, dtype=np.int64).reshape(len(acc), len(self.svars))
+
+  def step(self, X):
+    """
+    Takes one random enabled transition from every row of X.
+    Returns (successors, alive) where alive is False for rows with no valid transition; those rows are left unchanged.
+    """
+    enabled = np.column_stack([guard(X) for guard,_,_ in self.disjuncts])
+    choice = np.argmax(self.rng.random(enabled.shape) * enabled, axis=1)
+    alive = enabled.any(axis=1)
+
+    Y = X.copy()
+    for j, (_, updates, check) in enumerate(self.disjuncts):
+      rows = choice == j
+      Xj = X[rows]
+      Yj = self.rng.integers(-self.havoc, self.havoc+1, size=Xj.shape)
+      for col, (coeffs, const) in updates.items():
+        Yj[:,col] = Xj.dot(coeffs) + const
+      if check is not None:
+        alive[rows] &= check(np.hstack([Xj, Yj]))
+      Y[rows] = Yj
+    Y[~alive] = X[~alive]
+    return Y, alive
+
+  def run(self):
+    """
+    Simulates self.traces random traces of length self.depth from Init and caches every state visited.
+    Returns the first visited state violating P(as ConjFml of equalities), None if there is none.
+    """
+    if not self.disjuncts:
+      return None
+    inits = self._init_states()
+    if len(inits) == 0:
+      return None
+
+    X = inits[self.rng.integers(len(inits), size=self.traces)]
+    visited = [X]
+    for i in range(self.depth+1):
+      bad = ~self.prop(X)
+      if bad.any():
+        self.counterexample = self.as_cube(X[bad][0])
+        break
+      if i == self.depth:
+        break
+      X, alive = self.step(X)
+      visited.append(X[alive])
+
+    self.states = np.unique(np.vstack([self.states] + visited), axis=0)
+    return self.counterexample
+
+  def as_cube(self, row):
+    """
+    Returns state(row) as a ConjFml of equalities.
+    """
+    cube = ConjFml()
+    cube.add([var == int(val) for var,val in zip(self.svars, row)])
+    return cube
+
+  def hits(self, cube):
+    """
+    Returns True if cube(ConjFml or BoolRef over state vars) contains a cached reachable state.
+    False only means no such state is known.
+    """
+    if len(self.states) == 0:
+      return False
+    try:
+      f = compile_fml(cube.as_expr() if isinstance(cube, Goal) else cube, self.index)
+    except ValueError:
+      return False
+    return bool(f(self.states).any())